@@ -4,13 +4,44 @@ from flask_cors import CORS
 from dotenv import load_dotenv
 import json
 import re # Import re for regex
+import time
+import uuid
 from services.llm_service import call_llm_api, LLMServiceError
+from services.batch_store import (
+    BatchJobStore, BatchStoreError, BatchJobExistsError, is_valid_batch_id, ITEM_DONE, ITEM_FAILED, ITEM_IN_FLIGHT,
+)
+from services.batch_runner import BatchRunner
+from services.llm_scheduler import get_default_scheduler
+from services.http_compression import init_compression
+from services.config_store import SharedConfigStore, ConfigStoreError
+from services.llm_service import reset_sessions
+from services.request_timing import (
+    RequestTimingRecorder, SamplingProfiler, init_request_timing, timed,
+)
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False  # 允许非ASCII字符在JSON中
 
+# 按 Accept-Encoding 协商 gzip/brotli 压缩 JSON 响应
+init_compression(app, min_size=int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024")))
+
+# 每个请求的分阶段耗时：通过 Server-Timing 响应头返回，并保存在环形缓冲区中供 /api/debug/timings 查看。
+# PROFILER_ENABLED=true 时启用采样分析器，保存最慢 N 个请求的折叠栈（可直接生成火焰图）。
+_profiler = None
+if os.getenv("PROFILER_ENABLED", "false").lower() == "true":
+    _profiler = SamplingProfiler(
+        output_dir=os.getenv("PROFILER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')),
+        slowest_n=int(os.getenv("PROFILER_SLOWEST_N", "10")),
+        interval=float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000,
+    )
+timing_recorder = RequestTimingRecorder(
+    buffer_size=int(os.getenv("REQUEST_TIMING_BUFFER_SIZE", "200")),
+    profiler=_profiler,
+)
+init_request_timing(app, timing_recorder)
+
 # 使用更明确的 CORS 配置
 CORS(app, resources={r"/api/*": {"origins": "http://localhost:5173"}})
 # 或者允许所有源进行测试：
@@ -27,6 +58,166 @@ MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o")
 # OPENAI_COMPATIBLE_API_KEY = "YOUR_API_KEY_HERE" # 非常重要：不要将真实密钥硬编码在此处提交！
 # =====================================================================
 
+# 所有 worker 进程共享的配置（本地 SQLite，带版本号）。首次启动时用上面的环境变量初始化；
+# 之后启动时，.env 中相对上次启动有修改的值会作为新版本写入（.env 与数据库不一致时会打印警告）。
+# /api/config 的修改会写入新版本，其他 worker 在 CONFIG_POLL_INTERVAL 秒内无需重启即可生效。
+# 路由中请通过 config_store.current() 读取配置，而不是直接使用上面的环境变量。
+CONFIG_DB_PATH = os.getenv("CONFIG_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.db'))
+config_store = SharedConfigStore(
+    CONFIG_DB_PATH,
+    defaults={
+        "api_url": OPENAI_COMPATIBLE_API_URL,
+        "api_key": OPENAI_COMPATIBLE_API_KEY,
+        "model": MODEL_NAME,
+    },
+    poll_interval=float(os.getenv("CONFIG_POLL_INTERVAL", "1.0")),
+)
+
+def _rebuild_pools_on_endpoint_change(previous, current):
+    if previous.api_url != current.api_url:
+        print(f"API endpoint changed to {current.api_url}; rebuilding upstream connection pools")
+        reset_sessions(keep_url=current.api_url)
+
+config_store.on_change(_rebuild_pools_on_endpoint_change)
+
+# 批量批改任务持久化在本地磁盘上，服务重启后只会继续未完成的条目
+BATCH_JOBS_DIR = os.getenv("BATCH_JOBS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_jobs'))
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))
+# 单次批改调用的超时秒数（带图片、max_tokens=8192，需要比普通请求更长），
+# 以及超时/429/503 等临时错误的最大尝试次数
+BATCH_LLM_TIMEOUT = int(os.getenv("BATCH_LLM_TIMEOUT", "120"))
+BATCH_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "3"))
+# 流式批量上传：单行（单个学生）最大字节数即每个请求的内存上限；
+# 排队未处理的条目达到上限时暂停读取请求体（背压）
+BATCH_STREAM_MAX_LINE_BYTES = int(os.getenv("BATCH_STREAM_MAX_LINE_BYTES", str(32 * 1024 * 1024)))
+BATCH_STREAM_MAX_QUEUED = int(os.getenv("BATCH_STREAM_MAX_QUEUED", "8"))
+# 多个 worker 进程（如 gunicorn）共享 BATCH_JOBS_DIR 时，只有拿到 resume.lock 的一个进程
+# 在启动时恢复未完成的任务，并每 BATCH_RESUME_INTERVAL 秒接管所属进程已退出的任务。
+# gunicorn 请不要使用 --preload：恢复线程需要在 worker 进程中启动。
+BATCH_RESUME_INTERVAL = float(os.getenv("BATCH_RESUME_INTERVAL", "60"))
+# 已完成的批量任务保留天数，超过后由负责恢复的进程删除（0 表示永久保留）
+BATCH_JOB_RETENTION_DAYS = float(os.getenv("BATCH_JOB_RETENTION_DAYS", "30"))
+
+batch_store = BatchJobStore(BATCH_JOBS_DIR)
+# The config is read at call time so /api/config updates reach running jobs
+batch_runner = BatchRunner(
+    batch_store,
+    lambda: config_store.current()[:3],
+    max_workers=BATCH_MAX_WORKERS,
+    timeout=BATCH_LLM_TIMEOUT,
+    max_attempts=BATCH_MAX_ATTEMPTS,
+)
+
+# With `python app.py` and the reloader on, this module also runs in the watcher
+# process (WERKZEUG_RUN_MAIN unset), which must not take over batch jobs.
+_is_reloader_watcher = (
+    __name__ == '__main__'
+    and os.environ.get('FLASK_BACKGROUND', 'false').lower() != 'true'
+    and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+)
+if not _is_reloader_watcher:
+    _resumed = batch_runner.start_resumer(
+        os.path.join(BATCH_JOBS_DIR, 'resume.lock'),
+        BATCH_RESUME_INTERVAL,
+        retention=BATCH_JOB_RETENTION_DAYS * 86400,
+    )
+    if _resumed:
+        print(f"Resumed {len(_resumed)} unfinished batch job(s): {', '.join(_resumed)}")
+
+_BATCH_RESULT_STATUS = {
+    ITEM_DONE: "completed",
+    ITEM_FAILED: "error",
+    ITEM_IN_FLIGHT: "processing",
+}
+
+def _request_user():
+    """Identify who a request is for, used to share upstream capacity fairly."""
+    return request.headers.get('X-User-Id') or request.remote_addr or "anonymous"
+
+def _requested_fields():
+    """Parse ?fields=a,b,c into a set of field names, or None when not given."""
+    raw = request.args.get('fields')
+    if not raw:
+        return None
+    return {name.strip() for name in raw.split(',') if name.strip()}
+
+def _is_slim_request():
+    """?slim=1 drops raw upstream payloads from responses."""
+    return request.args.get('slim', 'false').lower() in ('1', 'true', 'yes')
+
+def _select_fields(data, fields, always=()):
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields or key in always}
+
+def _page_args():
+    """Parse ?offset=&limit= into (offset, limit); limit is None when not given.
+
+    Raises ValueError unless offset is an integer >= 0 and limit an integer >= 1.
+    Routes parse these before doing any work so a bad value is a plain 400.
+    """
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        raise ValueError("offset and limit must be integers")
+    if offset < 0:
+        raise ValueError("offset must be >= 0")
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be >= 1")
+    return offset, limit
+
+def _batch_job_response(job, offset=0, limit=None):
+    """Converts a stored batch job into the response shape the frontend expects.
+
+    offset/limit (from _page_args) select one page of results; the summary
+    still covers the whole job. ?fields=status,error keeps only these keys in
+    each result (studentId is always kept).
+    """
+    fields = _requested_fields()
+
+    completed = 0
+    errors = 0
+    for item in job["items"]:
+        if item["state"] == ITEM_DONE:
+            completed += 1
+        elif item["state"] == ITEM_FAILED:
+            errors += 1
+
+    page_items = job["items"][offset:offset + limit] if limit is not None else job["items"][offset:]
+    results = []
+    for item in page_items:
+        result = {
+            "studentId": item["studentId"],
+            "status": _BATCH_RESULT_STATUS.get(item["state"], "pending"),
+        }
+        if item["state"] == ITEM_DONE:
+            result["feedbackMarkdown"] = item["feedbackMarkdown"]
+        elif item["state"] == ITEM_FAILED:
+            result["error"] = item["error"]
+        results.append(_select_fields(result, fields, always=("studentId",)))
+
+    response_data = {
+        "batchId": job["batchId"],
+        "results": results,
+        "summary": {
+            "total": len(job["items"]),
+            "completed": completed,
+            "errors": errors,
+            "averageScore": None,
+        },
+        "finished": job.get("sealed", True) and completed + errors == len(job["items"]),
+    }
+    if limit is not None or offset:
+        next_offset = offset + len(results)
+        response_data["page"] = {
+            "offset": offset,
+            "limit": limit,
+            "total": len(job["items"]),
+            "nextOffset": next_offset if next_offset < len(job["items"]) else None,
+        }
+    return response_data
+
 @app.route('/')
 def hello_world():
     return 'Hello, World! This is the AI Grader backend with CORS enabled.'
@@ -48,11 +239,13 @@ def analyze_multi_answer():
       "imageAnalyses": [{ order, analysis, keyPoints: [] }]
     }
     """
-    if not OPENAI_COMPATIBLE_API_URL or not OPENAI_COMPATIBLE_API_KEY:
+    llm_config = config_store.current()
+    if not llm_config.api_url or not llm_config.api_key:
         return jsonify(error="API URL or Key is not configured in the backend."), 500
 
     try:
-        payload = request.get_json(silent=True) or {}
+        with timed("parse_body"):
+            payload = request.get_json(silent=True) or {}
         images = payload.get('images') or []
 
         if not isinstance(images, list) or len(images) == 0:
@@ -74,9 +267,9 @@ def analyze_multi_answer():
         )
 
         ai_result = call_llm_api(
-            api_url=OPENAI_COMPATIBLE_API_URL,
-            api_key=OPENAI_COMPATIBLE_API_KEY,
-            model=MODEL_NAME,
+            api_url=llm_config.api_url,
+            api_key=llm_config.api_key,
+            model=llm_config.model,
             prompt_text=analysis_prompt,
             image_data_url=first_image_data,
             max_tokens=8192,
@@ -88,15 +281,16 @@ def analyze_multi_answer():
             message = ai_result['choices'][0].get('message')
             if message and isinstance(message.get('content'), str):
                 analyzed_text = message['content']
-                # Try to extract JSON rubric from markdown ```json block
-                match = re.search(r"```json\s*([\s\S]*?)\s*```", analyzed_text, re.DOTALL)
-                if match:
-                    extracted = match.group(1).strip()
-                    try:
-                        parsed = json.loads(extracted)
-                        suggested_rubric_json_str = json.dumps(parsed, indent=2)
-                    except json.JSONDecodeError:
-                        suggested_rubric_json_str = extracted
+                with timed("rubric_extract"):
+                    # Try to extract JSON rubric from markdown ```json block
+                    match = re.search(r"```json\s*([\s\S]*?)\s*```", analyzed_text, re.DOTALL)
+                    if match:
+                        extracted = match.group(1).strip()
+                        try:
+                            parsed = json.loads(extracted)
+                            suggested_rubric_json_str = json.dumps(parsed, indent=2)
+                        except json.JSONDecodeError:
+                            suggested_rubric_json_str = extracted
 
         # Basic per-image placeholder analyses
         image_analyses = []
@@ -109,14 +303,14 @@ def analyze_multi_answer():
                 "keyPoints": ["key point 1", "key point 2"],
             })
 
-        return jsonify({
+        return jsonify(_select_fields({
             "analyzedText": analyzed_text or "Multi-image analysis generated.",
             "suggestedRubricJson": suggested_rubric_json_str or json.dumps({
                 "criteria": [],
                 "totalScore": 100
             }, indent=2),
             "imageAnalyses": image_analyses,
-        }), 200
+        }, _requested_fields())), 200
 
     except LLMServiceError as e:
         error_response = {"error": e.message}
@@ -133,11 +327,13 @@ def analyze_multi_answer():
 
 @app.route('/api/grade', methods=['POST'])
 def grade_submission():
-    if not OPENAI_COMPATIBLE_API_URL or not OPENAI_COMPATIBLE_API_KEY:
+    llm_config = config_store.current()
+    if not llm_config.api_url or not llm_config.api_key:
         return jsonify(error="API URL or Key is not configured in the backend."), 500
 
     try:
-        data = request.json
+        with timed("parse_body"):
+            data = request.json
         if not data:
             return jsonify(error="No data provided in the request body"), 400
 
@@ -155,9 +351,9 @@ def grade_submission():
 
         # Call the llm_service
         ai_result = call_llm_api(
-            api_url=OPENAI_COMPATIBLE_API_URL,
-            api_key=OPENAI_COMPATIBLE_API_KEY,
-            model=MODEL_NAME, 
+            api_url=llm_config.api_url,
+            api_key=llm_config.api_key,
+            model=llm_config.model,
             prompt_text=prompt_text,
             image_data_url=final_image_data_url,
             max_tokens=8192
@@ -208,11 +404,17 @@ def grade_submission():
 
 @app.route('/api/analyze_answer', methods=['POST'])
 def analyze_standard_answer():
-    if not OPENAI_COMPATIBLE_API_URL or not OPENAI_COMPATIBLE_API_KEY:
+    """Analyze one standard answer image and suggest a rubric.
+
+    ?slim=1 omits the raw upstream `llmResponse`; ?fields=analyzedText,... keeps only the listed keys.
+    """
+    llm_config = config_store.current()
+    if not llm_config.api_url or not llm_config.api_key:
         return jsonify(error="API URL or Key is not configured in the backend."), 500
 
     try:
-        data = request.json
+        with timed("parse_body"):
+            data = request.json
         if not data:
             return jsonify(error="No data provided in the request body"), 400
 
@@ -229,9 +431,9 @@ def analyze_standard_answer():
         analysis_prompt = """You are an AI assistant. Your task is to analyze the provided image, which represents a standard answer to a question. Extract all key components, concepts, steps, or pieces of information present in the answer. Present this information in a structured format (e.g., bullet points, numbered list, or a simple JSON structure) that would be easy for a teacher to use to create a detailed grading rubric. For example, if it's a math problem, identify the steps and the final answer. If it's a diagram, identify the key labels and relationships. If you provide a JSON structure for the rubric, ensure it is a valid JSON and enclosed in a markdown JSON code block like ```json ... ```."""
 
         ai_result_from_service = call_llm_api(
-            api_url=OPENAI_COMPATIBLE_API_URL,
-            api_key=OPENAI_COMPATIBLE_API_KEY,
-            model=MODEL_NAME,
+            api_url=llm_config.api_url,
+            api_key=llm_config.api_key,
+            model=llm_config.model,
             prompt_text=analysis_prompt,
             image_data_url=final_image_data_url,
             max_tokens=8192 
@@ -250,28 +452,33 @@ def analyze_standard_answer():
                 print(ai_content) # Log the full AI content
                 print("-------------------------------------------------------------------------");
 
-                # Attempt to extract JSON from the AI content
-                # This regex looks for a markdown JSON code block
-                match = re.search(r"```json\s*([\s\S]*?)\s*```", ai_content, re.DOTALL)
-                if match:
-                    extracted_json_str = match.group(1).strip()
-                    try:
-                        # Validate and prettify the JSON
-                        parsed_json = json.loads(extracted_json_str)
-                        suggested_rubric_json_str = json.dumps(parsed_json, indent=2)
-                        print("Successfully extracted and validated suggested Rubric JSON.")
-                    except json.JSONDecodeError as je:
-                        print(f"Failed to parse extracted JSON for rubric: {je}")
-                        print(f"Extracted string was: {extracted_json_str}")
-                        # Keep ai_content as is, suggested_rubric_json_str will remain None or be the raw (potentially invalid) string
-                        # For robustness, you might want to pass the raw string if parsing fails and let frontend decide
-                        suggested_rubric_json_str = extracted_json_str # Or set to None if only valid JSON is desired
+                with timed("rubric_extract"):
+                    # Attempt to extract JSON from the AI content
+                    # This regex looks for a markdown JSON code block
+                    match = re.search(r"```json\s*([\s\S]*?)\s*```", ai_content, re.DOTALL)
+                    if match:
+                        extracted_json_str = match.group(1).strip()
+                        try:
+                            # Validate and prettify the JSON
+                            parsed_json = json.loads(extracted_json_str)
+                            suggested_rubric_json_str = json.dumps(parsed_json, indent=2)
+                            print("Successfully extracted and validated suggested Rubric JSON.")
+                        except json.JSONDecodeError as je:
+                            print(f"Failed to parse extracted JSON for rubric: {je}")
+                            print(f"Extracted string was: {extracted_json_str}")
+                            # Keep ai_content as is, suggested_rubric_json_str will remain None or be the raw (potentially invalid) string
+                            # For robustness, you might want to pass the raw string if parsing fails and let frontend decide
+                            suggested_rubric_json_str = extracted_json_str # Or set to None if only valid JSON is desired
 
         response_data = {
             "llmResponse": ai_result_from_service, # The full response from the LLM service
             "analyzedText": ai_content, # The textual content part of the LLM response
             "suggestedRubricJson": suggested_rubric_json_str # The extracted and prettified JSON rubric string, or None
         }
+        if _is_slim_request():
+            # analyzedText already carries the content; skip the duplicated raw payload
+            del response_data["llmResponse"]
+        response_data = _select_fields(response_data, _requested_fields())
         
         return jsonify(response_data), 200
 
@@ -291,11 +498,50 @@ def analyze_standard_answer():
         traceback.print_exc()
         return jsonify(error=f"An unexpected server error occurred: {str(e)}"), 500
 
+@app.route('/api/scheduler_stats', methods=['GET'])
+def scheduler_stats():
+    """Report queue depth, running calls and wait times per priority class."""
+    return jsonify(get_default_scheduler().stats()), 200
+
+@app.route('/api/debug/timings', methods=['GET'])
+def debug_timings():
+    """Return per-phase timings of recent requests (newest first, or ?sort=slowest)."""
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify(error="limit must be an integer"), 400
+    if limit < 1:
+        return jsonify(error="limit must be >= 1"), 400
+    slowest = request.args.get('sort') == 'slowest'
+    return jsonify({
+        "requests": timing_recorder.recent(limit=limit, slowest=slowest),
+        "profilerEnabled": _profiler is not None,
+    }), 200
+
+@app.route('/api/debug/profiles', methods=['GET'])
+def debug_profiles():
+    """List the folded-stack profiles kept for the slowest requests."""
+    if _profiler is None:
+        return jsonify(error="Profiler is disabled; set PROFILER_ENABLED=true"), 404
+    return jsonify(profiles=_profiler.profiles()), 200
+
+@app.route('/api/debug/profiles/<name>', methods=['GET'])
+def debug_profile(name):
+    """Download one profile as folded stacks (input for flamegraph.pl or speedscope)."""
+    if _profiler is None:
+        return jsonify(error="Profiler is disabled; set PROFILER_ENABLED=true"), 404
+    path = _profiler.profile_path(name)
+    if not path or not os.path.exists(path):
+        return jsonify(error=f"Profile not found: {name}"), 404
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
 @app.route('/api/test_connection', methods=['POST'])
 def test_connection():
     """Test API connection with provided credentials."""
     try:
-        data = request.json
+        with timed("parse_body"):
+            data = request.json
         if not data:
             return jsonify(error="No data provided"), 400
 
@@ -316,7 +562,8 @@ def test_connection():
             model=model_name,
             prompt_text=test_prompt,
             image_data_url=None,  # No image for connection test
-            max_tokens=50
+            max_tokens=50,
+            pooled=False  # Credentials under test may be ad hoc; don't keep a pool per host
         )
 
         # Check if we got a valid response
@@ -340,10 +587,12 @@ def test_connection():
 def get_config():
     """Get current backend configuration."""
     try:
+        llm_config = config_store.current()
         current_config = {
-            "apiUrl": OPENAI_COMPATIBLE_API_URL or "",
-            "apiKey": OPENAI_COMPATIBLE_API_KEY[:8] + "..." if OPENAI_COMPATIBLE_API_KEY else "",  # Masked for security
-            "hasApiKey": bool(OPENAI_COMPATIBLE_API_KEY)
+            "apiUrl": llm_config.api_url or "",
+            "apiKey": llm_config.api_key[:8] + "..." if llm_config.api_key else "",  # Masked for security
+            "hasApiKey": bool(llm_config.api_key),
+            "version": llm_config.version
         }
         return jsonify(current_config), 200
     except Exception as e:
@@ -352,9 +601,10 @@ def get_config():
 
 @app.route('/api/config', methods=['POST'])
 def update_config():
-    """Update backend configuration and save to .env file."""
+    """Update backend configuration, save it to .env and publish it to all workers."""
     try:
-        data = request.json
+        with timed("parse_body"):
+            data = request.json
         if not data:
             return jsonify(error="No data provided"), 400
 
@@ -404,22 +654,24 @@ def update_config():
             with open(env_path, 'w', encoding='utf-8') as f:
                 f.writelines(updated_lines)
             
-            # Update global variables (for current session)
-            global OPENAI_COMPATIBLE_API_URL, OPENAI_COMPATIBLE_API_KEY
-            OPENAI_COMPATIBLE_API_URL = api_url
-            OPENAI_COMPATIBLE_API_KEY = api_key
+            # Publish a new version to the shared store; every worker picks it up
+            llm_config = config_store.update(api_url=api_url, api_key=api_key)
             
-            print(f"Configuration updated successfully: API URL set to {api_url}")
+            print(f"Configuration updated successfully: API URL set to {api_url} (version {llm_config.version})")
             
             return jsonify({
                 "success": True,
                 "message": "Configuration updated successfully",
-                "apiUrl": api_url
+                "apiUrl": api_url,
+                "version": llm_config.version
             }), 200
             
         except IOError as e:
             print(f"Error writing to .env file: {e}")
             return jsonify(error="Failed to update configuration file"), 500
+        except ConfigStoreError as e:
+            print(f"Error writing shared configuration: {e}")
+            return jsonify(error="Failed to update shared configuration"), 500
             
     except Exception as e:
         print(f"Error updating config: {e}")
@@ -429,67 +681,228 @@ def update_config():
 
 @app.route('/api/batch_grade', methods=['POST'])
 def batch_grade():
-    """Mock batch grading endpoint to unblock frontend integration.
+    """Create a persisted batch grading job and grade every submission.
 
     Expected payload shape (from frontend):
     {
       "standardAnswerImages": [{ data, order }],
       "standardAnalysis": string,
       "rubric": string,
-      "studentSubmissions": [{ id, name, imageData }]
+      "studentSubmissions": [{ id, name, imageData }],
+      "batchId": string, # optional, client-chosen id (letters, digits, '_' or '-')
+      "wait": boolean    # optional, respond only once grading has finished
     }
 
     Returns:
     {
       "batchId": string,
       "results": [{ studentId, status, feedbackMarkdown? , error? }],
-      "summary": { total, completed, errors, averageScore? }
+      "summary": { total, completed, errors, averageScore? },
+      "finished": boolean,
+      "page": { offset, limit, total, nextOffset }   # only with ?offset>=0 / ?limit>=1
     }
+
+    ?fields=status,error trims each result, e.g. to poll progress without the markdown.
+
+    By default the response is 202 as soon as the job is on disk, and the client
+    polls /api/batch_status/<batchId> until "finished" is true. If the backend
+    restarts mid-batch, the job is resumed on startup under the same batchId.
+    A client that sends its own batchId knows it even if the response is lost;
+    re-posting an existing batchId reports that job instead of creating one.
+    Pass "wait": true (or ?wait=true) to block until grading is done instead.
     """
+    llm_config = config_store.current()
+    if not llm_config.api_url or not llm_config.api_key:
+        return jsonify(error="API URL or Key is not configured in the backend."), 500
     try:
-        payload = request.get_json(silent=True) or {}
+        offset, limit = _page_args()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    try:
+        with timed("parse_body"):
+            payload = request.get_json(silent=True) or {}
         submissions = payload.get('studentSubmissions') or []
 
         if not isinstance(submissions, list):
             return jsonify(error="studentSubmissions must be an array"), 400
-
-        batch_id = f"batch_{int(__import__('time').time()*1000)}"
-        results = []
-        completed = 0
-        errors = 0
-
-        # Simple mock: mark all as completed with a placeholder markdown
-        for sub in submissions:
-            student_id = (sub or {}).get('id', 'unknown')
-            feedback_md = (
-                f"# Feedback for {student_id}\n\n"
-                f"- Overall: Looks good.\n"
-                f"- Suggested improvements: Add more details in step 2.\n"
+        for index, submission in enumerate(submissions):
+            if not isinstance(submission, dict):
+                return jsonify(error=f"studentSubmissions[{index}] must be an object"), 400
+        batch_id = payload.get('batchId')
+        if batch_id is not None and not is_valid_batch_id(batch_id):
+            return jsonify(error="batchId must be 1-128 letters, digits, '_' or '-'"), 400
+
+        batch_id = batch_id or f"batch_{int(time.time()*1000)}_{uuid.uuid4().hex[:8]}"
+        try:
+            batch_store.create_job(
+                batch_id,
+                submissions,
+                standard_analysis=payload.get('standardAnalysis') or "",
+                rubric=payload.get('rubric') or "",
+                owner=_request_user(),
             )
-            results.append({
-                "studentId": student_id,
-                "status": "completed",
-                "feedbackMarkdown": feedback_md,
-            })
-            completed += 1
+            batch_runner.start(batch_id)
+        except BatchJobExistsError:
+            # A retry of a request that already reached us; report that job
+            pass
+
+        if bool(payload.get('wait')) or request.args.get('wait', 'false').lower() == 'true':
+            batch_runner.wait(batch_id)
+
+        job = batch_store.get_job(batch_id)
+        if job is None:
+            # The id's directory exists without job.json: another request is
+            # still spooling it, or a crash left it behind (the resumer
+            # removes those after a few minutes)
+            return jsonify(error=f"Batch job {batch_id} is still being created; retry shortly",
+                           batchId=batch_id), 409
+        response_data = _batch_job_response(job, offset, limit)
+        return jsonify(response_data), 200 if response_data["finished"] else 202
+    except BatchStoreError as e:
+        print(f"Batch store error in /api/batch_grade: {e}")
+        return jsonify(error=f"Failed to persist batch job: {str(e)}"), 500
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify(error=f"Unexpected error: {str(e)}"), 500
 
-        summary = {
-            "total": len(submissions),
-            "completed": completed,
-            "errors": errors,
-            "averageScore": None,
-        }
+@app.route('/api/batch_grade_stream', methods=['POST'])
+def batch_grade_stream():
+    """Streaming variant of /api/batch_grade for very large batches.
+
+    The body is NDJSON (one JSON object per line), sent in one piece or with
+    chunked transfer encoding:
+      line 1:   { "standardAnalysis": string, "rubric": string, "batchId": string (optional) }
+      line 2..: { "id", "name", "imageData" }   # one student submission per line
+
+    Submissions are parsed one at a time, spooled to disk and dispatched for
+    grading as they arrive, so memory use is bounded by the largest line
+    (BATCH_STREAM_MAX_LINE_BYTES) rather than by the batch size. When
+    BATCH_STREAM_MAX_QUEUED items are waiting to be graded, reading the body
+    pauses until the workers catch up.
+
+    Returns the same shape as /api/batch_grade: 202 once the upload is
+    complete, or the final result with ?wait=true. Submissions received before
+    an interrupted upload are still graded; a client that chose the batchId can
+    poll them from /api/batch_status/<batchId>.
+    """
+    llm_config = config_store.current()
+    if not llm_config.api_url or not llm_config.api_key:
+        return jsonify(error="API URL or Key is not configured in the backend."), 500
+    try:
+        offset, limit = _page_args()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    def read_line():
+        line = request.stream.readline(BATCH_STREAM_MAX_LINE_BYTES + 1)
+        if len(line) > BATCH_STREAM_MAX_LINE_BYTES:
+            raise _StreamLineTooLongError(f"Line exceeds {BATCH_STREAM_MAX_LINE_BYTES} bytes")
+        return line
 
-        return jsonify({
-            "batchId": batch_id,
-            "results": results,
-            "summary": summary,
-        }), 200
+    batch_id = None
+    try:
+        header_line = read_line()
+        while header_line and not header_line.strip():
+            header_line = read_line()
+        header = json.loads(header_line) if header_line else {}
+        if not isinstance(header, dict):
+            return jsonify(error="The first line must be a JSON object with standardAnalysis and rubric"), 400
+
+        requested_id = header.get('batchId')
+        if requested_id is not None and not is_valid_batch_id(requested_id):
+            return jsonify(error="batchId must be 1-128 letters, digits, '_' or '-'"), 400
+        new_id = requested_id or f"batch_{int(time.time()*1000)}_{uuid.uuid4().hex[:8]}"
+        try:
+            batch_store.create_job(
+                new_id,
+                [],
+                standard_analysis=header.get('standardAnalysis') or "",
+                rubric=header.get('rubric') or "",
+                owner=_request_user(),
+                sealed=False,
+            )
+        except BatchJobExistsError as e:
+            # Never seal or grade into someone else's job
+            return jsonify(error=str(e), batchId=new_id), 409
+        # From here on the error handlers close the job so its items still get graded
+        batch_id = new_id
+        batch_runner.start(batch_id)
+
+        line_number = 1
+        while True:
+            line = read_line()
+            if not line:
+                break
+            line_number += 1
+            if not line.strip():
+                continue
+            try:
+                with timed("parse_body"):
+                    submission = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON on line {line_number}: {e}")
+            if not isinstance(submission, dict):
+                raise ValueError(f"Line {line_number} must be a JSON object")
+            del line
+
+            batch_runner.wait_for_queue_below(batch_id, BATCH_STREAM_MAX_QUEUED)
+            index = batch_store.add_item(batch_id, submission)
+            del submission
+            batch_runner.enqueue(batch_id, index)
+
+        batch_store.seal(batch_id)
+        batch_runner.close(batch_id)
+
+        if request.args.get('wait', 'false').lower() == 'true':
+            batch_runner.wait(batch_id)
+
+        response_data = _batch_job_response(batch_store.get_job(batch_id), offset, limit)
+        return jsonify(response_data), 200 if response_data["finished"] else 202
+    except ValueError as e:
+        # Items received before the bad line are still graded under batchId
+        _close_stream_job(batch_id)
+        error_response = {"error": str(e)}
+        if batch_id:
+            error_response["batchId"] = batch_id
+        return jsonify(error_response), 413 if isinstance(e, _StreamLineTooLongError) else 400
+    except BatchStoreError as e:
+        _close_stream_job(batch_id)
+        print(f"Batch store error in /api/batch_grade_stream: {e}")
+        return jsonify(error=f"Failed to persist batch job: {str(e)}"), 500
     except Exception as e:
+        _close_stream_job(batch_id)
         import traceback
         traceback.print_exc()
         return jsonify(error=f"Unexpected error: {str(e)}"), 500
 
+class _StreamLineTooLongError(ValueError):
+    pass
+
+def _close_stream_job(batch_id):
+    if not batch_id:
+        return
+    try:
+        batch_store.seal(batch_id)
+    finally:
+        batch_runner.close(batch_id)
+
+@app.route('/api/batch_status/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    """Return the current progress of a persisted batch job."""
+    try:
+        offset, limit = _page_args()
+        job = batch_store.get_job(batch_id)
+    except (ValueError, BatchStoreError) as e:
+        return jsonify(error=str(e)), 400
+    if not job:
+        return jsonify(error=f"Batch job not found: {batch_id}"), 404
+
+    response_data = _batch_job_response(job, offset, limit)
+    response_data["running"] = batch_runner.is_running(batch_id)
+    return jsonify(response_data), 200
+
 # Debug route listing - only run when script is executed directly, not imported
 # Commented out to avoid I/O errors when running in background
 # print("\n--- Debug: Checking registered routes before app.run() ---")
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline bulk grading: grade a directory (or glob) of scanned answers without the frontend.
+
+Results are appended to a JSONL file one line per image as soon as each image is graded,
+and images already present in the output are skipped, so an interrupted run (or a cron
+job over a growing archive) can simply be started again.
+
+Examples:
+    python grade_cli.py --assignment exam1.json scans/exam1/ -o exam1_results.jsonl
+    python grade_cli.py --rubric rubric.md --standard-answer answer.md "scans/**/*.png" -o out.jsonl
+
+The assignment JSON uses the same field names as /api/batch_grade:
+    { "rubric": "...", "standardAnalysis": "..." }
+
+API settings are read from .env (OPENAI_COMPATIBLE_API_URL, OPENAI_COMPATIBLE_API_KEY, MODEL_NAME)
+unless given on the command line.
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+
+from check_new_api_env import get_image_data_url
+from services.batch_runner import build_grading_prompt
+from services.llm_scheduler import PRIORITY_BATCH
+from services.llm_service import call_llm_api, extract_message_content, LLMServiceError
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+
+
+def collect_images(inputs):
+    """Expands directories and glob patterns into a sorted, de-duplicated list of image paths."""
+    paths = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            for root, _, files in os.walk(entry):
+                for name in files:
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.add(os.path.abspath(os.path.join(root, name)))
+        else:
+            for match in glob.glob(entry, recursive=True):
+                if os.path.isfile(match) and match.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.add(os.path.abspath(match))
+    return sorted(paths)
+
+
+def load_graded_files(output_path, retry_errors=False):
+    """Returns the set of image paths already recorded in the JSONL output."""
+    graded = set()
+    if not os.path.exists(output_path):
+        return graded
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn last line from an interrupted run; that image is graded again
+            if retry_errors and record.get('status') != 'completed':
+                continue
+            if record.get('file'):
+                graded.add(record['file'])
+    return graded
+
+
+def _terminate_torn_line(output_path):
+    """Ends a line left unfinished by an interrupted run so new records start on their own line."""
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return
+    with open(output_path, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def load_assignment(args):
+    """Reads rubric and standard answer analysis from --assignment or --rubric/--standard-answer."""
+    rubric = ""
+    standard_analysis = ""
+    if args.assignment:
+        with open(args.assignment, 'r', encoding='utf-8') as f:
+            assignment = json.load(f)
+        rubric = assignment.get('rubric') or ""
+        standard_analysis = assignment.get('standardAnalysis') or ""
+    if args.rubric:
+        with open(args.rubric, 'r', encoding='utf-8') as f:
+            rubric = f.read()
+    if args.standard_answer:
+        with open(args.standard_answer, 'r', encoding='utf-8') as f:
+            standard_analysis = f.read()
+    return rubric, standard_analysis
+
+
+def grade_image(path, prompt_text, api_url, api_key, model, timeout):
+    """Grades one image and returns the JSONL record for it."""
+    started = time.time()
+    record = {
+        "file": path,
+        "studentId": os.path.splitext(os.path.basename(path))[0],
+    }
+    image_data_url = get_image_data_url(path)
+    if not image_data_url:
+        record.update(status="error", error="Unreadable or unsupported image file")
+    else:
+        try:
+            ai_result = call_llm_api(
+                api_url=api_url,
+                api_key=api_key,
+                model=model,
+                prompt_text=prompt_text,
+                image_data_url=image_data_url,
+                max_tokens=8192,
+                timeout=timeout,
+                priority=PRIORITY_BATCH,
+                user="cli",
+            )
+            feedback = extract_message_content(ai_result)
+            if feedback:
+                record.update(status="completed", feedbackMarkdown=feedback)
+            else:
+                record.update(status="error", error="Failed to get valid Markdown feedback from AI service.")
+        except LLMServiceError as e:
+            record.update(status="error", error=e.message, statusCode=e.status_code)
+    record["elapsedMs"] = int((time.time() - started) * 1000)
+    record["gradedAt"] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return record
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Grade a directory of scanned answers to JSONL.")
+    parser.add_argument('inputs', nargs='+', help="Image directories and/or glob patterns")
+    parser.add_argument('-o', '--output', required=True, help="JSONL file to append results to")
+    parser.add_argument('--assignment', help="JSON file with 'rubric' and 'standardAnalysis'")
+    parser.add_argument('--rubric', help="Text/Markdown file with the grading rubric")
+    parser.add_argument('--standard-answer', help="Text/Markdown file with the standard answer analysis")
+    parser.add_argument('-j', '--concurrency', type=int, default=4, help="Images graded in parallel (default: 4)")
+    parser.add_argument('--retry-errors', action='store_true', help="Grade again images whose last result was an error")
+    parser.add_argument('--api-url', help="Overrides OPENAI_COMPATIBLE_API_URL")
+    parser.add_argument('--api-key', help="Overrides OPENAI_COMPATIBLE_API_KEY")
+    parser.add_argument('--model', help="Overrides MODEL_NAME")
+    parser.add_argument('--timeout', type=int, default=120, help="Upstream request timeout in seconds (default: 120)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.assignment and not args.rubric:
+        print("Error: an assignment is required (--assignment or --rubric).", file=sys.stderr)
+        return 2
+
+    load_dotenv()
+    api_url = args.api_url or os.getenv("OPENAI_COMPATIBLE_API_URL")
+    api_key = args.api_key or os.getenv("OPENAI_COMPATIBLE_API_KEY")
+    model = args.model or os.getenv("MODEL_NAME", "gpt-4o")
+    if not api_url or not api_key:
+        print("Error: API URL or Key is not configured (.env or --api-url/--api-key).", file=sys.stderr)
+        return 2
+
+    # The CLI is the only user of the upstream here, so -j is the limit: it
+    # overrides any LLM_MAX_CONCURRENCY from .env (which also sizes the HTTP
+    # pool), and no slot is held back for interactive calls that never come.
+    # Set before the first call creates the scheduler.
+    os.environ["LLM_MAX_CONCURRENCY"] = str(max(1, args.concurrency))
+    os.environ["LLM_INTERACTIVE_RESERVED"] = "0"
+
+    rubric, standard_analysis = load_assignment(args)
+    prompt_text = build_grading_prompt(standard_analysis, rubric)
+
+    images = collect_images(args.inputs)
+    graded = load_graded_files(args.output, retry_errors=args.retry_errors)
+    todo = [path for path in images if path not in graded]
+    print(f"Found {len(images)} image(s), {len(images) - len(todo)} already in {args.output}, {len(todo)} to grade.")
+    if not todo:
+        return 0
+
+    _terminate_torn_line(args.output)
+    done = 0
+    errors = 0
+    started = time.time()
+    with open(args.output, 'a', encoding='utf-8') as out, \
+            ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        futures = {
+            executor.submit(grade_image, path, prompt_text, api_url, api_key, model, args.timeout): path
+            for path in todo
+        }
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            done += 1
+            if record["status"] != "completed":
+                errors += 1
+            elapsed = time.time() - started
+            rate = done / elapsed * 60 if elapsed > 0 else 0.0
+            remaining = (len(todo) - done) / (done / elapsed) if done and elapsed > 0 else 0.0
+            print(f"[{done}/{len(todo)}] {record['status']:<9} {os.path.basename(record['file'])} "
+                  f"({record['elapsedMs']} ms) | {rate:.1f} images/min, ~{remaining:.0f}s left", flush=True)
+
+    elapsed = time.time() - started
+    print(f"Done: {done - errors} completed, {errors} error(s) in {elapsed:.1f}s "
+          f"({done / elapsed * 60 if elapsed > 0 else 0:.1f} images/min).")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
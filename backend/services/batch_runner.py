@@ -0,0 +1,339 @@
+import threading
+import time
+import logging
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from services.batch_store import BatchJobStore, BatchStoreError, ITEM_PENDING
+from services.llm_service import call_llm_api, extract_message_content, LLMServiceError
+from services.llm_scheduler import PRIORITY_BATCH
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process acts as the resumer
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Returns (api_url, api_key, model) at call time, so configuration changes
+# made while a job is running apply to the items that have not started yet.
+ConfigProvider = Callable[[], Tuple[Optional[str], Optional[str], str]]
+
+# Upstream errors worth another attempt: timeouts, rate limits, overload and
+# connection failures (reported by call_llm_api as 503)
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def build_grading_prompt(standard_analysis: str, rubric: str) -> str:
+    """Builds the prompt used to grade one student's submission in a batch."""
+    return (
+        "You are an experienced teacher grading a student's handwritten answer shown in the image.\n\n"
+        "## Standard answer analysis\n"
+        f"{standard_analysis or '(not provided)'}\n\n"
+        "## Grading rubric\n"
+        f"{rubric or '(not provided)'}\n\n"
+        "Grade the student's answer strictly against the rubric. Reply in Markdown with a score for each "
+        "criterion, the total score, and concise feedback on mistakes and how to improve."
+    )
+
+
+class BatchRunner:
+    """
+    Grades the pending items of persisted batch jobs.
+
+    Each running job gets up to `max_workers` threads pulling its own items, and
+    every LLM call goes through the shared scheduler in the batch class, so
+    concurrent jobs share the upstream fairly instead of queueing one behind
+    another.
+
+    Every item is claimed through the store (pending -> in_flight) before its LLM
+    call, so starting or resuming the same job twice never grades a submission
+    twice, and items already done or failed are never paid for again. A job is
+    only run by the process holding its store claim; when several worker
+    processes share the store, the others leave it alone.
+
+    An item whose LLM call fails with a transient error goes back to pending
+    and is retried after `retry_delay` seconds, up to `max_attempts` attempts
+    in total; other errors fail it straight away.
+    """
+
+    def __init__(
+        self,
+        store: BatchJobStore,
+        config_provider: ConfigProvider,
+        max_workers: int = 4,
+        timeout: int = 120,
+        max_attempts: int = 3,
+        retry_delay: float = 5.0,
+    ):
+        self.store = store
+        self._config_provider = config_provider
+        self._max_workers = max(1, max_workers)
+        self._timeout = timeout
+        self._max_attempts = max(1, max_attempts)
+        self._retry_delay = retry_delay
+        self._lock = threading.Lock()
+        # Notified whenever a queued item is picked up or a job finishes.
+        self._changed = threading.Condition(self._lock)
+        # batch_id -> {"queue": deque of item indexes, "remaining": int, "workers": int,
+        #              "sealed": bool, "done": Event, "job": job snapshot for the prompt}
+        self._active: Dict[str, dict] = {}
+        self._resume_lock_file = None
+
+    def start(self, batch_id: str) -> bool:
+        """
+        Schedules all pending items of a job.
+
+        An unsealed job stays active after its current items are done, waiting
+        for more items from enqueue() until close() is called.
+
+        Returns:
+            False if the job is unknown, already running, or owned by another process.
+        """
+        job = self.store.get_job(batch_id)
+        if not job:
+            return False
+        if not self.store.claim(batch_id):
+            logger.info(f"Batch runner: {batch_id} is owned by another process")
+            return False
+        pending = [item["index"] for item in job["items"] if item["state"] == ITEM_PENDING]
+        sealed = job.get("sealed", True)
+
+        with self._lock:
+            if batch_id in self._active:
+                return False
+            if not pending and sealed:
+                self.store.release(batch_id)
+                return True
+            tracker = {
+                "queue": deque(pending),
+                "remaining": len(pending),
+                "workers": 0,
+                "sealed": sealed,
+                "done": threading.Event(),
+                "job": job,
+            }
+            self._active[batch_id] = tracker
+            if pending:
+                logger.info(f"Batch runner: scheduling {len(pending)} item(s) of {batch_id}")
+            self._spawn_workers(batch_id, tracker)
+        return True
+
+    def enqueue(self, batch_id: str, index: int) -> None:
+        """Schedules an item just added to a running, unsealed job."""
+        with self._lock:
+            tracker = self._active.get(batch_id)
+            if not tracker or tracker["sealed"]:
+                raise BatchStoreError(f"Batch job is not accepting items: {batch_id}")
+            tracker["queue"].append(index)
+            tracker["remaining"] += 1
+            self._spawn_workers(batch_id, tracker)
+
+    def close(self, batch_id: str) -> None:
+        """Marks a running job's intake as complete so it finishes once its queue drains."""
+        with self._lock:
+            tracker = self._active.get(batch_id)
+            if not tracker:
+                return
+            tracker["sealed"] = True
+            if tracker["remaining"] <= 0:
+                self._finish(batch_id, tracker)
+
+    def wait_for_queue_below(self, batch_id: str, limit: int, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks while the job has `limit` or more items queued but not yet started.
+
+        Used for backpressure: ingestion stops reading new submissions until the
+        workers catch up. Returns False on timeout.
+        """
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: batch_id not in self._active or len(self._active[batch_id]["queue"]) < limit,
+                timeout,
+            )
+
+    def wait(self, batch_id: str, timeout: Optional[float] = None) -> bool:
+        """Blocks until the job has no running items. Returns False on timeout."""
+        with self._lock:
+            tracker = self._active.get(batch_id)
+        if not tracker:
+            return True
+        return tracker["done"].wait(timeout)
+
+    def is_running(self, batch_id: str) -> bool:
+        with self._lock:
+            return batch_id in self._active
+
+    def resume_unfinished(self) -> List[str]:
+        """
+        Restarts every unfinished job on disk that no live process owns.
+
+        Items that were in flight when their owner stopped are put back to
+        pending first; done and failed items are left untouched. Jobs whose
+        upload was cut off are sealed with the items that had arrived.
+
+        Returns:
+            The ids of the resumed jobs.
+        """
+        resumed = []
+        for batch_id in self.store.unfinished_job_ids():
+            # Jobs this process owns are either running or about to be started
+            if self.store.owns(batch_id) or not self.store.claim(batch_id):
+                continue
+            try:
+                self.store.seal(batch_id)
+                reset = self.store.reset_in_flight(batch_id)
+                started = self.start(batch_id)
+            except BatchStoreError as e:
+                logger.error(f"Batch runner: failed to resume {batch_id}: {e}")
+                started = False
+            if started:
+                logger.info(f"Batch runner: resumed {batch_id} ({reset} interrupted item(s) requeued)")
+                resumed.append(batch_id)
+            elif not self.is_running(batch_id):
+                self.store.release(batch_id)
+        return resumed
+
+    def start_resumer(self, lock_path: str, interval: float = 60.0,
+                      retention: float = 0.0) -> Optional[List[str]]:
+        """
+        Makes this process the one that resumes unfinished jobs, if no other live process is.
+
+        The role is an exclusive lock on `lock_path` held until the process
+        exits, so with several workers exactly one resumes jobs at startup and
+        a replacement worker takes over when it dies. The holder resumes now
+        and then rescans every `interval` seconds for jobs whose owning process
+        has died since, also removing job directories left without a job.json
+        and, if `retention` > 0, finished jobs older than `retention` seconds.
+
+        Returns:
+            The ids resumed now, or None if another process holds the role.
+        """
+        with self._lock:
+            if self._resume_lock_file is not None:
+                return []
+            lock_file = open(lock_path, "a")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    return None
+            self._resume_lock_file = lock_file
+
+        resumed = self._housekeeping(retention)
+        if interval > 0:
+            threading.Thread(target=self._resume_loop, args=(interval, retention), name="batch-resumer",
+                             daemon=True).start()
+        return resumed
+
+    def _resume_loop(self, interval: float, retention: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self._housekeeping(retention)
+            except Exception as e:
+                logger.error(f"Batch runner: periodic resume failed: {e}")
+
+    def _housekeeping(self, retention: float) -> List[str]:
+        self.store.remove_incomplete_jobs()
+        resumed = self.resume_unfinished()
+        if retention > 0:
+            # After the scan above, which is what records finished jobs' ages
+            self.store.purge_finished(retention)
+        return resumed
+
+    def _spawn_workers(self, batch_id: str, tracker: dict) -> None:
+        # Called with self._lock held
+        while tracker["workers"] < min(self._max_workers, len(tracker["queue"])):
+            tracker["workers"] += 1
+            threading.Thread(
+                target=self._worker,
+                args=(batch_id, tracker),
+                name=f"batch-{batch_id}-{tracker['workers']}",
+                daemon=True,
+            ).start()
+
+    def _worker(self, batch_id: str, tracker: dict) -> None:
+        while True:
+            with self._lock:
+                if not tracker["queue"]:
+                    tracker["workers"] -= 1
+                    return
+                index = tracker["queue"].popleft()
+                self._changed.notify_all()
+            self._run_item(batch_id, index, tracker["job"])
+
+    def _run_item(self, batch_id: str, index: int, job: dict) -> None:
+        retrying = False
+        try:
+            if not self.store.mark_in_flight(batch_id, index):
+                return
+            image_data_url = self.store.read_input(batch_id, index)
+            if not image_data_url:
+                # Grading without the image would only produce a made-up score
+                self.store.mark_failed(batch_id, index, "Submission has no image data.")
+                return
+            api_url, api_key, model = self._config_provider()
+            try:
+                ai_result = call_llm_api(
+                    api_url=api_url,
+                    api_key=api_key,
+                    model=model,
+                    prompt_text=build_grading_prompt(job["standardAnalysis"], job["rubric"]),
+                    image_data_url=image_data_url,
+                    max_tokens=8192,
+                    timeout=self._timeout,
+                    priority=PRIORITY_BATCH,
+                    user=job.get("owner") or None,
+                    group=batch_id,
+                )
+                feedback = extract_message_content(ai_result)
+                if feedback:
+                    self.store.mark_done(batch_id, index, feedback)
+                else:
+                    self.store.mark_failed(batch_id, index, "Failed to get valid Markdown feedback from AI service.")
+            except LLMServiceError as e:
+                if e.status_code in TRANSIENT_STATUS_CODES:
+                    retrying = self.store.mark_retry(batch_id, index, e.message, self._max_attempts)
+                else:
+                    self.store.mark_failed(batch_id, index, e.message)
+        except (BatchStoreError, OSError) as e:
+            logger.error(f"Batch runner: item {index} of {batch_id} could not be processed: {e}")
+        except Exception as e:
+            logger.exception(f"Batch runner: unexpected error on item {index} of {batch_id}: {e}")
+            try:
+                self.store.mark_failed(batch_id, index, f"Unexpected error: {str(e)}")
+            except Exception:
+                pass
+        finally:
+            if retrying:
+                timer = threading.Timer(self._retry_delay, self._requeue, args=(batch_id, index))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._item_finished(batch_id)
+
+    def _requeue(self, batch_id: str, index: int) -> None:
+        # The item still counts towards "remaining", so the job stays active meanwhile
+        with self._lock:
+            tracker = self._active.get(batch_id)
+            if tracker:
+                tracker["queue"].append(index)
+                self._spawn_workers(batch_id, tracker)
+
+    def _item_finished(self, batch_id: str) -> None:
+        with self._lock:
+            tracker = self._active.get(batch_id)
+            if not tracker:
+                return
+            tracker["remaining"] -= 1
+            if tracker["remaining"] <= 0 and tracker["sealed"]:
+                self._finish(batch_id, tracker)
+
+    def _finish(self, batch_id: str, tracker: dict) -> None:
+        # Called with self._lock held
+        tracker["done"].set()
+        del self._active[batch_id]
+        self.store.release(batch_id)
+        self._changed.notify_all()
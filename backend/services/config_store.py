@@ -0,0 +1,214 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Callable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LLMConfig(NamedTuple):
+    """One immutable version of the upstream settings; read it once per request."""
+    api_url: Optional[str]
+    api_key: Optional[str]
+    model: str
+    version: int
+
+
+class ConfigStoreError(Exception):
+    """Raised when the shared configuration database cannot be read or written."""
+    pass
+
+
+class SharedConfigStore:
+    """
+    Upstream LLM configuration shared by every worker process through a local SQLite file.
+
+    Each update inserts a new row in `config_versions`, so a change is a single
+    committed transaction and readers always see a complete version. Workers call
+    current(), which re-reads the database at most every `poll_interval` seconds
+    and swaps in the newer version as one object; listeners registered with
+    on_change() run in that worker when its version changes.
+
+    `defaults` (the values from .env) seed the first version. They are also
+    remembered in `config_seed`: when a later start sees a value that differs
+    from the remembered seed, the .env was edited and that value is applied as
+    a new version. Values that only differ because of an /api/config update
+    are kept, with a warning.
+    """
+
+    def __init__(self, db_path: str, defaults: dict, poll_interval: float = 1.0):
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[LLMConfig, LLMConfig], None]] = []
+        self._last_poll = 0.0
+        self._init_db(defaults)
+        self._config = self._read_latest()
+
+    def current(self) -> LLMConfig:
+        """Returns the latest configuration, refreshing from the database if the poll interval has passed."""
+        now = time.monotonic()
+        if now - self._last_poll >= self.poll_interval:
+            self.refresh()
+        return self._config
+
+    def refresh(self) -> LLMConfig:
+        """Re-reads the database now and notifies listeners if the version changed."""
+        with self._lock:
+            self._last_poll = time.monotonic()
+            try:
+                latest = self._read_latest()
+            except ConfigStoreError as e:
+                logger.error(f"Config store: keeping version {self._config.version}, refresh failed: {e}")
+                return self._config
+            previous = self._config
+            if latest.version == previous.version:
+                return previous
+            self._config = latest
+        logger.info(f"Config store: switched to configuration version {latest.version}")
+        self._notify(previous, latest)
+        return latest
+
+    def update(self, **changes) -> LLMConfig:
+        """
+        Stores a new configuration version and applies it to this worker immediately.
+
+        Args:
+            changes: Any of api_url, api_key, model; omitted fields keep their current value.
+
+        Returns:
+            The new configuration.
+        """
+        unknown = set(changes) - {"api_url", "api_key", "model"}
+        if unknown:
+            raise ValueError(f"Unknown configuration fields: {', '.join(sorted(unknown))}")
+        with self._lock:
+            try:
+                with self._connect() as conn:
+                    # BEGIN IMMEDIATE serialises writers across processes, so two
+                    # workers updating at once cannot both derive from the same base.
+                    conn.execute("BEGIN IMMEDIATE")
+                    row = conn.execute(
+                        "SELECT data FROM config_versions ORDER BY version DESC LIMIT 1"
+                    ).fetchone()
+                    data = json.loads(row[0]) if row else {}
+                    data.update(changes)
+                    conn.execute(
+                        "INSERT INTO config_versions (data, updated_at) VALUES (?, ?)",
+                        (json.dumps(data), time.time()),
+                    )
+            except sqlite3.Error as e:
+                raise ConfigStoreError(f"Failed to write configuration: {e}")
+        return self.refresh()
+
+    def on_change(self, listener: Callable[[LLMConfig, LLMConfig], None]) -> None:
+        """Registers listener(previous, current), called in this worker after its config changes."""
+        self._listeners.append(listener)
+
+    # ---- internals ---------------------------------------------------------
+
+    @contextmanager
+    def _connect(self):
+        """Yields a connection inside a transaction scope (commit on success, rollback on error), then closes it."""
+        # isolation_level=None: transactions are controlled explicitly with BEGIN
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self, defaults: dict) -> None:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS config_versions ("
+                    " version INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " data TEXT NOT NULL,"
+                    " updated_at REAL NOT NULL)"
+                )
+                # Single row: the .env values the database was last seeded from
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS config_seed ("
+                    " id INTEGER PRIMARY KEY CHECK (id = 1),"
+                    " data TEXT NOT NULL)"
+                )
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT data FROM config_versions ORDER BY version DESC LIMIT 1"
+                ).fetchone()
+                seed_row = conn.execute("SELECT data FROM config_seed WHERE id = 1").fetchone()
+                if row is None:
+                    # First start: seed from the environment (.env)
+                    conn.execute(
+                        "INSERT INTO config_versions (data, updated_at) VALUES (?, ?)",
+                        (json.dumps(defaults), time.time()),
+                    )
+                else:
+                    self._apply_env_changes(conn, json.loads(row[0]), json.loads(seed_row[0]) if seed_row else None,
+                                            defaults)
+                conn.execute(
+                    "INSERT OR REPLACE INTO config_seed (id, data) VALUES (1, ?)",
+                    (json.dumps(defaults),),
+                )
+        except sqlite3.Error as e:
+            raise ConfigStoreError(f"Failed to initialise configuration database {self.db_path}: {e}")
+
+    def _apply_env_changes(self, conn, current: dict, seed: Optional[dict], env: dict) -> None:
+        # Key names only in the logs: values include the API key
+        edited = sorted(
+            key for key, value in env.items()
+            if value is not None and (seed is None or seed.get(key) != value) and current.get(key) != value
+        )
+        if edited:
+            data = dict(current)
+            data.update({key: env[key] for key in edited})
+            conn.execute(
+                "INSERT INTO config_versions (data, updated_at) VALUES (?, ?)",
+                (json.dumps(data), time.time()),
+            )
+            logger.warning(
+                f"Config store: {', '.join(edited)} changed in .env since the last start; "
+                f"applying the .env value as a new configuration version"
+            )
+        overridden = sorted(
+            key for key, value in env.items()
+            if value is not None and key not in edited and current.get(key) != value
+        )
+        if overridden:
+            logger.warning(
+                f"Config store: the .env value of {', '.join(overridden)} differs from the database "
+                f"({self.db_path}); using the value set through /api/config"
+            )
+
+    def _read_latest(self) -> LLMConfig:
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT version, data FROM config_versions ORDER BY version DESC LIMIT 1"
+                ).fetchone()
+        except sqlite3.Error as e:
+            raise ConfigStoreError(f"Failed to read configuration: {e}")
+        version, raw = row
+        data = json.loads(raw)
+        return LLMConfig(
+            api_url=data.get("api_url"),
+            api_key=data.get("api_key"),
+            model=data.get("model") or "gpt-4o",
+            version=version,
+        )
+
+    def _notify(self, previous: LLMConfig, current: LLMConfig) -> None:
+        for listener in self._listeners:
+            try:
+                listener(previous, current)
+            except Exception as e:
+                logger.error(f"Config store: change listener failed: {e}")
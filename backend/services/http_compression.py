@@ -0,0 +1,83 @@
+import gzip
+from typing import Optional
+
+from flask import Flask, request
+
+try:
+    import brotli  # Optional: pip install brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson")
+
+
+def _accepted_encodings(header: str) -> dict:
+    """Parses an Accept-Encoding header into {coding: q-value}."""
+    accepted = {}
+    for part in (header or "").split(","):
+        pieces = part.strip().split(";")
+        coding = pieces[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in pieces[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(header: str) -> Optional[str]:
+    """Picks "br" or "gzip" from an Accept-Encoding header, preferring brotli when installed."""
+    accepted = _accepted_encodings(header)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = None
+    best_q = 0.0
+    for coding in candidates:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def init_compression(app: Flask, min_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5) -> None:
+    """
+    Compresses JSON responses according to the request's Accept-Encoding.
+
+    Responses smaller than `min_size` bytes, streamed responses and responses
+    that already carry a Content-Encoding are sent unchanged.
+    """
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding == "br":
+            compressed = brotli.compress(data, quality=brotli_quality)
+        elif encoding == "gzip":
+            compressed = gzip.compress(data, compresslevel=gzip_level)
+        else:
+            return response
+
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        response.headers["Content-Length"] = str(len(compressed))
+        return response
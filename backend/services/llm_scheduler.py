@@ -0,0 +1,218 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Optional
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+
+class _Ticket:
+    __slots__ = ("priority", "user", "group", "enqueued_at", "granted")
+
+    def __init__(self, priority: str, user: str, group: str):
+        self.priority = priority
+        self.user = user
+        self.group = group
+        self.enqueued_at = time.monotonic()
+        self.granted = threading.Event()
+
+
+class _ClassStats:
+    __slots__ = ("active", "granted", "total_wait", "max_wait", "last_wait")
+
+    def __init__(self):
+        self.active = 0
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+
+class LLMScheduler:
+    """
+    Admission control for upstream LLM calls.
+
+    At most `max_concurrency` calls run at once, and batch calls never take the
+    last `interactive_reserved` of them. When a slot frees up:
+      1. interactive requests go first, in arrival order, except that a batch
+         request waiting longer than `batch_max_wait` seconds may go ahead of
+         them once per `aged_batch_every` interactive grants (starvation
+         protection that cannot itself starve interactive work);
+      2. otherwise an aged batch request goes first;
+      3. otherwise batch requests are served round-robin across users, and
+         round-robin across each user's groups (batch jobs), so one large
+         batch cannot monopolise the upstream.
+
+    All limits apply per process: with several worker processes the upstream
+    sees up to max_concurrency calls from each of them.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        batch_max_wait: float = 30.0,
+        interactive_reserved: int = 1,
+        aged_batch_every: int = 4,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.batch_max_wait = batch_max_wait
+        # With a single slot nothing can be reserved without starving batch work
+        self.interactive_reserved = min(max(0, interactive_reserved), self.max_concurrency - 1)
+        self.aged_batch_every = max(1, aged_batch_every)
+        self._lock = threading.Lock()
+        self._active = 0
+        # Interactive grants since an aged batch ticket last went ahead of one
+        self._interactive_since_aged = self.aged_batch_every
+        self._interactive: Deque[_Ticket] = deque()
+        # user -> group -> FIFO of tickets; OrderedDicts double as round-robin rings
+        self._batch: "OrderedDict[str, OrderedDict[str, Deque[_Ticket]]]" = OrderedDict()
+        self._stats: Dict[str, _ClassStats] = {p: _ClassStats() for p in PRIORITY_CLASSES}
+
+    @contextmanager
+    def slot(self, priority: str = PRIORITY_INTERACTIVE, user: Optional[str] = None, group: Optional[str] = None):
+        """
+        Blocks until an upstream slot is granted, and releases it on exit.
+
+        Args:
+            priority: PRIORITY_INTERACTIVE or PRIORITY_BATCH.
+            user: Who the work is for; batch slots are shared fairly between users.
+            group: Sub-key within a user (e.g. the batch id) shared fairly as well.
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+        ticket = _Ticket(priority, user or "anonymous", group or "default")
+        with self._lock:
+            if priority == PRIORITY_INTERACTIVE:
+                self._interactive.append(ticket)
+            else:
+                groups = self._batch.setdefault(ticket.user, OrderedDict())
+                groups.setdefault(ticket.group, deque()).append(ticket)
+            self._dispatch()
+        ticket.granted.wait()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._stats[priority].active -= 1
+                self._dispatch()
+
+    def stats(self) -> dict:
+        """Returns queue depth, running calls and wait times per priority class."""
+        with self._lock:
+            now = time.monotonic()
+            batch_waiting = [t for groups in self._batch.values() for q in groups.values() for t in q]
+            waiting = {PRIORITY_INTERACTIVE: list(self._interactive), PRIORITY_BATCH: batch_waiting}
+            classes = {}
+            for priority in PRIORITY_CLASSES:
+                s = self._stats[priority]
+                queued = waiting[priority]
+                classes[priority] = {
+                    "queued": len(queued),
+                    "active": s.active,
+                    "granted": s.granted,
+                    "avgWaitMs": round(s.total_wait / s.granted * 1000, 1) if s.granted else 0.0,
+                    "maxWaitMs": round(s.max_wait * 1000, 1),
+                    "lastWaitMs": round(s.last_wait * 1000, 1),
+                    "oldestQueuedMs": round(max((now - t.enqueued_at for t in queued), default=0.0) * 1000, 1),
+                }
+            return {
+                "maxConcurrency": self.max_concurrency,
+                "interactiveReserved": self.interactive_reserved,
+                "active": self._active,
+                "batchUsers": len(self._batch),
+                "classes": classes,
+            }
+
+    # ---- internals (called with self._lock held) ---------------------------
+
+    def _dispatch(self) -> None:
+        while self._active < self.max_concurrency:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            wait = time.monotonic() - ticket.enqueued_at
+            s = self._stats[ticket.priority]
+            s.active += 1
+            s.granted += 1
+            s.total_wait += wait
+            s.last_wait = wait
+            s.max_wait = max(s.max_wait, wait)
+            self._active += 1
+            ticket.granted.set()
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        batch_allowed = self._stats[PRIORITY_BATCH].active < self.max_concurrency - self.interactive_reserved
+        starving = None
+        if batch_allowed:
+            oldest = self._oldest_batch_ticket()
+            if oldest is not None and time.monotonic() - oldest.enqueued_at >= self.batch_max_wait:
+                starving = oldest
+
+        if self._interactive and (starving is None or self._interactive_since_aged < self.aged_batch_every):
+            self._interactive_since_aged += 1
+            return self._interactive.popleft()
+        if starving is not None:
+            if self._interactive:
+                self._interactive_since_aged = 0
+            self._remove_batch_ticket(starving)
+            return starving
+        if self._batch and batch_allowed:
+            return self._pop_batch_round_robin()
+        return None
+
+    def _oldest_batch_ticket(self) -> Optional[_Ticket]:
+        oldest = None
+        for groups in self._batch.values():
+            for queue in groups.values():
+                if queue and (oldest is None or queue[0].enqueued_at < oldest.enqueued_at):
+                    oldest = queue[0]
+        return oldest
+
+    def _pop_batch_round_robin(self) -> _Ticket:
+        # Take from the first user's first group, then rotate both to the back.
+        user, groups = next(iter(self._batch.items()))
+        group, queue = next(iter(groups.items()))
+        ticket = queue.popleft()
+        groups.move_to_end(group)
+        self._batch.move_to_end(user)
+        self._prune(user, group)
+        return ticket
+
+    def _remove_batch_ticket(self, ticket: _Ticket) -> None:
+        self._batch[ticket.user][ticket.group].remove(ticket)
+        self._prune(ticket.user, ticket.group)
+
+    def _prune(self, user: str, group: str) -> None:
+        groups = self._batch[user]
+        if not groups[group]:
+            del groups[group]
+        if not groups:
+            del self._batch[user]
+
+
+_default_scheduler: Optional[LLMScheduler] = None
+_default_lock = threading.Lock()
+
+
+def get_default_scheduler() -> LLMScheduler:
+    """
+    Returns the scheduler shared by every upstream call in the process.
+
+    Created on first use so that settings loaded from .env by the app are seen.
+    Each worker process has its own, so LLM_MAX_CONCURRENCY is per process.
+    """
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = LLMScheduler(
+                max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+                batch_max_wait=float(os.getenv("LLM_BATCH_MAX_WAIT", "30")),
+                interactive_reserved=int(os.getenv("LLM_INTERACTIVE_RESERVED", "1")),
+                aged_batch_every=int(os.getenv("LLM_AGED_BATCH_EVERY", "4")),
+            )
+        return _default_scheduler
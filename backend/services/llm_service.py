@@ -3,7 +3,14 @@ import json
 import os
 import logging
 import sys
-from typing import Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from services.llm_scheduler import get_default_scheduler, PRIORITY_INTERACTIVE
+from services.request_timing import timed, record_phase
 
 # Configure logging to use stderr (more reliable than stdout for background processes)
 logging.basicConfig(
@@ -16,6 +23,53 @@ logger = logging.getLogger(__name__)
 # It's good practice for services to be able to access necessary configurations,
 # but for now, we'll assume API URL and KEY are passed in or read by the service itself if needed.
 
+# One pooled session per upstream endpoint (scheme + host), so keep-alive
+# connections are reused across calls instead of reconnecting every time.
+_sessions: Dict[Tuple[str, str], requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def _endpoint_key(api_url: str) -> Tuple[str, str]:
+    parts = urlsplit(api_url)
+    return parts.scheme.lower(), parts.netloc.lower()
+
+def _get_session(api_url: str) -> requests.Session:
+    key = _endpoint_key(api_url)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            pool_size = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return session
+
+@contextmanager
+def _session_for(api_url: str, pooled: bool):
+    """Yields the pooled session for api_url, or a throwaway one that is closed afterwards."""
+    if pooled:
+        yield _get_session(api_url)
+        return
+    session = requests.Session()
+    try:
+        yield session
+    finally:
+        session.close()
+
+def reset_sessions(keep_url: Optional[str] = None) -> None:
+    """
+    Closes pooled upstream connections, e.g. after the configured endpoint changes.
+
+    Args:
+        keep_url: Optional endpoint whose pool should be kept open.
+    """
+    keep = _endpoint_key(keep_url) if keep_url else None
+    with _sessions_lock:
+        for key in list(_sessions):
+            if key != keep:
+                _sessions.pop(key).close()
+
 class LLMServiceError(Exception):
     """Custom exception for LLM service errors."""
     def __init__(self, message, status_code=None, details=None):
@@ -31,7 +85,11 @@ def call_llm_api(
     prompt_text: str,
     image_data_url: Optional[str] = None,  # Optional for pure text, required for vision
     max_tokens: int = 8192,
-    timeout: int = 30
+    timeout: int = 30,
+    priority: str = PRIORITY_INTERACTIVE,
+    user: Optional[str] = None,
+    group: Optional[str] = None,
+    pooled: bool = True
 ) -> dict:
     """
     Calls a generic OpenAI-compatible LLM API, supporting vision if image_data_url is provided.
@@ -44,6 +102,11 @@ def call_llm_api(
         image_data_url: Optional. Base64 data URL for the image if using a vision model.
         max_tokens: The maximum number of tokens to generate.
         timeout: Request timeout in seconds.
+        priority: Scheduling class, "interactive" (default) or "batch".
+        user: Who the call is for; batch calls are shared fairly between users.
+        group: Batch job the call belongs to; shared fairly within a user.
+        pooled: False for one-off calls to an endpoint that may never be used
+            again (e.g. a connection test), so no pool is kept open for it.
 
     Returns:
         The JSON response from the LLM API as a dictionary.
@@ -61,26 +124,29 @@ def call_llm_api(
         "Accept-Charset": "utf-8"
     }
 
-    # Build message content - use simple string for text-only, array for multimodal
-    if image_data_url:
-        messages_content = [
-            {"type": "text", "text": prompt_text},
-            {"type": "image_url", "image_url": {"url": image_data_url}}
-        ]
-    else:
-        # For text-only, use simple string format (more compatible)
-        messages_content = prompt_text
-
-    payload = {
-        "model": model,
-        "messages": [
-            {
-                "role": "user",
-                "content": messages_content
-            }
-        ],
-        "max_tokens": max_tokens
-    }
+    with timed("build_payload"):
+        # Build message content - use simple string for text-only, array for multimodal
+        if image_data_url:
+            messages_content = [
+                {"type": "text", "text": prompt_text},
+                {"type": "image_url", "image_url": {"url": image_data_url}}
+            ]
+        else:
+            # For text-only, use simple string format (more compatible)
+            messages_content = prompt_text
+
+        payload = {
+            "model": model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": messages_content
+                }
+            ],
+            "max_tokens": max_tokens
+        }
+        # Serialise here so the cost shows up in this phase rather than in "upstream"
+        body = json.dumps(payload).encode('utf-8')
 
     logger.info(f"LLM Service: Sending request to: {api_url} with model: {model}")
 
@@ -88,13 +154,21 @@ def call_llm_api(
     proxies = {"http": None, "https": None}
 
     try:
-        response = requests.post(
-            api_url,
-            headers=headers,
-            json=payload,
-            proxies=proxies,
-            timeout=timeout
-        )
+        # Every upstream call waits for a slot, so interactive requests are not
+        # stuck behind a large batch.
+        wait_started = time.perf_counter()
+        with get_default_scheduler().slot(priority, user=user, group=group):
+            record_phase("queue_wait", time.perf_counter() - wait_started)
+            with timed("upstream"), _session_for(api_url, pooled) as session:
+                response = session.post(
+                    api_url,
+                    headers=headers,
+                    data=body,
+                    proxies=proxies,
+                    timeout=timeout
+                )
+                # Force the body download inside this phase; decode_json then measures parsing only
+                response.content
 
         if response.status_code != 200:
             error_content = response.text
@@ -112,7 +186,8 @@ def call_llm_api(
             )
 
         try:
-            result_json = response.json()
+            with timed("decode_json"):
+                result_json = response.json()
             logger.info("LLM Service: Successfully received and parsed JSON response from external API.")
             return result_json
         except json.JSONDecodeError as e:
@@ -136,4 +211,12 @@ def call_llm_api(
         raise  # Re-raise LLMServiceError as-is
     except Exception as e: # Catch any other unexpected errors
         logger.error(f"LLM Service Error: An unexpected error occurred: {e}")
-        raise LLMServiceError(f"An unexpected error occurred in LLM service: {str(e)}", status_code=500)
\ No newline at end of file
+        raise LLMServiceError(f"An unexpected error occurred in LLM service: {str(e)}", status_code=500)
+
+def extract_message_content(ai_result: dict) -> Optional[str]:
+    """Returns the text of the first choice in an OpenAI-style response, or None."""
+    if ai_result and isinstance(ai_result.get('choices'), list) and len(ai_result['choices']) > 0:
+        message = ai_result['choices'][0].get('message')
+        if message and isinstance(message.get('content'), str):
+            return message['content']
+    return None
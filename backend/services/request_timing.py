@@ -0,0 +1,264 @@
+import os
+import re
+import sys
+import itertools
+import time
+import threading
+import logging
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from flask import Flask, g, request
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimer:
+    """Accumulates per-phase durations (seconds) for one request; repeated phases add up."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+
+_current_timer: ContextVar[Optional[RequestTimer]] = ContextVar("current_request_timer", default=None)
+
+
+@contextmanager
+def timed(phase: str):
+    """
+    Times the enclosed block as `phase` of the current request.
+
+    A no-op outside an instrumented request (batch workers, the CLI), so
+    services can call it unconditionally.
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(phase, time.perf_counter() - started)
+
+
+def record_phase(phase: str, seconds: float) -> None:
+    """Adds an already measured duration to the current request, if any."""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.add(phase, seconds)
+
+
+def server_timing_header(phases: Dict[str, float], total: float) -> str:
+    """Formats phases as a Server-Timing header value (durations in milliseconds)."""
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class SamplingProfiler:
+    """
+    Opt-in sampling profiler for request threads.
+
+    One background thread samples the stacks of all threads currently serving a
+    request every `interval` seconds. When a request ends its samples are kept
+    only if it is among the `slowest_n` slowest seen so far; those are written to
+    `output_dir` as folded stacks ("frame;frame;frame count" per line), which
+    flamegraph.pl and speedscope read directly.
+
+    Only this run's files are listed, so on startup the directory is cleared of
+    profiles left by earlier runs (files of other live workers sharing the
+    directory are kept).
+    """
+
+    def __init__(self, output_dir: str, slowest_n: int = 10, interval: float = 0.005):
+        self.output_dir = output_dir
+        self.slowest_n = max(1, slowest_n)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active: Dict[int, Counter] = {}
+        self._kept: List[dict] = []  # sorted slowest first
+        # With the pid, keeps file names unique when requests end within the
+        # same second, also across worker processes sharing output_dir; the
+        # pid also tells _remove_stale_profiles() whose file it is
+        self._sequence = itertools.count(1)
+        os.makedirs(output_dir, exist_ok=True)
+        self._remove_stale_profiles()
+        threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True).start()
+
+    def begin(self) -> None:
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def end(self, label: str, duration: float) -> None:
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+            if not samples:
+                return
+            if len(self._kept) >= self.slowest_n and duration <= self._kept[-1]["durationMs"] / 1000:
+                return
+            sequence = next(self._sequence)
+
+        # File I/O happens outside the lock so it never stalls the sampler or other requests
+        safe_label = re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_") or "request"
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}-{sequence}_"
+                f"{int(duration * 1000)}ms_{safe_label}.folded")
+        path = os.path.join(self.output_dir, name)
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logger.error(f"Request profiler: failed to write {path}: {e}")
+            return
+
+        with self._lock:
+            self._kept.append({"file": name, "label": label, "durationMs": round(duration * 1000, 1),
+                               "samples": sum(samples.values())})
+            self._kept.sort(key=lambda entry: entry["durationMs"], reverse=True)
+            # May include the file just written if slower requests ended meanwhile
+            evicted = self._kept[self.slowest_n:]
+            del self._kept[self.slowest_n:]
+        for entry in evicted:
+            try:
+                os.remove(os.path.join(self.output_dir, entry["file"]))
+            except OSError:
+                pass
+
+    def discard(self) -> None:
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def profiles(self) -> List[dict]:
+        with self._lock:
+            return [dict(entry) for entry in self._kept]
+
+    def profile_path(self, name: str) -> Optional[str]:
+        with self._lock:
+            if any(entry["file"] == name for entry in self._kept):
+                return os.path.join(self.output_dir, name)
+        return None
+
+    def _remove_stale_profiles(self) -> None:
+        for name in os.listdir(self.output_dir):
+            if not name.endswith(".folded"):
+                continue
+            match = _PROFILE_PID_RE.match(name)
+            pid = int(match.group(1)) if match else None
+            if pid is not None and pid != os.getpid() and _process_alive(pid):
+                continue
+            try:
+                os.remove(os.path.join(self.output_dir, name))
+            except OSError:
+                pass
+
+    def _sample_loop(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_fold_stack(frame)] += 1
+
+
+# <date>-<time>_<pid>-<sequence>_<duration>ms_<label>.folded
+_PROFILE_PID_RE = re.compile(r"^\d{8}-\d{6}_(\d+)-\d+_")
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. PermissionError: it exists but belongs to someone else
+        return True
+    return True
+
+
+def _fold_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestTimingRecorder:
+    """Keeps the timing breakdown of the most recent requests in a ring buffer."""
+
+    def __init__(self, buffer_size: int = 200, profiler: Optional[SamplingProfiler] = None):
+        self._records = deque(maxlen=max(1, buffer_size))
+        self._lock = threading.Lock()
+        self.profiler = profiler
+
+    def add(self, record: dict) -> None:
+        with self._lock:
+            self._records.append(record)
+
+    def recent(self, limit: Optional[int] = None, slowest: bool = False) -> List[dict]:
+        with self._lock:
+            records = list(self._records)
+        if slowest:
+            records.sort(key=lambda record: record["totalMs"], reverse=True)
+        else:
+            records.reverse()
+        return records[:limit] if limit else records
+
+
+def init_request_timing(app: Flask, recorder: RequestTimingRecorder) -> None:
+    """
+    Times every /api/ request: phases recorded with timed() are returned in a
+    Server-Timing header and stored in `recorder`.
+    """
+
+    @app.before_request
+    def start_request_timer():
+        if not request.path.startswith('/api/') or request.path.startswith('/api/debug/'):
+            return
+        g.request_timer = RequestTimer()
+        g.request_timer_token = _current_timer.set(g.request_timer)
+        if recorder.profiler:
+            recorder.profiler.begin()
+
+    @app.after_request
+    def add_server_timing(response):
+        timer = g.pop('request_timer', None)
+        if timer is None:
+            return response
+        total = timer.total()
+        response.headers["Server-Timing"] = server_timing_header(timer.phases, total)
+        recorder.add({
+            "at": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "totalMs": round(total * 1000, 1),
+            "phasesMs": {name: round(seconds * 1000, 1) for name, seconds in timer.phases.items()},
+        })
+        if recorder.profiler:
+            recorder.profiler.end(f"{request.method}_{request.path}", total)
+        return response
+
+    @app.teardown_request
+    def clear_request_timer(exc):
+        token = g.pop('request_timer_token', None)
+        if token is not None:
+            _current_timer.reset(token)
+        if recorder.profiler and g.pop('request_timer', None) is not None:
+            # after_request did not run (unhandled error); drop the samples
+            recorder.profiler.discard()
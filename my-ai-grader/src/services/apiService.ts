@@ -205,21 +205,45 @@ class ApiService {
         };
       }
 
-      const response = await fetch('/api/batch_grade', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-          'X-API-Key': sanitizedConfig.apiKey,
-          'X-API-Url': sanitizedConfig.apiUrl,
-          'X-Model-Name': sanitizedConfig.modelName,
-        },
-        body: JSON.stringify(requestData),
-      });
+      // Chosen here so the job can still be polled if the response is lost,
+      // e.g. when the backend restarts mid-request
+      const batchId =
+        requestData.batchId ||
+        `batch_${Date.now()}_${Math.random().toString(36).slice(2, 10)}`;
+      const headers = {
+        'Content-Type': 'application/json',
+        'X-API-Key': sanitizedConfig.apiKey,
+        'X-API-Url': sanitizedConfig.apiUrl,
+        'X-Model-Name': sanitizedConfig.modelName,
+      };
 
-      const data = await response.json();
+      let response: Response | null = null;
+      try {
+        response = await fetch('/api/batch_grade', {
+          method: 'POST',
+          headers,
+          body: JSON.stringify({ ...requestData, batchId }),
+        });
+      } catch {
+        // The job may have been stored before the connection dropped; poll for it below
+      }
 
-      if (!response.ok) {
-        throw new Error(data.error || 'Batch grading failed');
+      let data: BatchGradeResponse | null = null;
+      if (response && response.ok) {
+        data = await response.json();
+      } else if (
+        response &&
+        response.status < 500 &&
+        response.status !== 409
+      ) {
+        const body = await response.json();
+        throw new Error(body.error || 'Batch grading failed');
+      }
+      // Otherwise (lost response, 5xx, or 409 while the job is still being
+      // created) the job may exist under our id, so poll for it
+
+      if (!data || !data.finished) {
+        data = await this.waitForBatch(batchId, headers);
       }
 
       return {
@@ -236,6 +260,53 @@ class ApiService {
     }
   }
 
+  // Poll a stored batch job until it has finished, then return its full results.
+  // Connection failures, 5xx and 404 (a job still being created) are retried,
+  // so a backend restart does not lose the job.
+  async waitForBatch(
+    batchId: string,
+    headers: Record<string, string>,
+    intervalMs = 2000,
+    maxConsecutiveErrors = 30,
+  ): Promise<BatchGradeResponse> {
+    let consecutiveErrors = 0;
+    let finished = false;
+    for (;;) {
+      await new Promise((resolve) => setTimeout(resolve, intervalMs));
+
+      // Only statuses while grading is under way; the markdown once at the end
+      const query = finished ? '' : '?fields=status';
+      let response: Response;
+      try {
+        response = await fetch(
+          `/api/batch_status/${encodeURIComponent(batchId)}${query}`,
+          { method: 'GET', headers },
+        );
+      } catch (error) {
+        if (++consecutiveErrors >= maxConsecutiveErrors) {
+          throw error;
+        }
+        continue;
+      }
+      if (response.status >= 500 || response.status === 404) {
+        if (++consecutiveErrors >= maxConsecutiveErrors) {
+          throw new Error(`Batch status unavailable (HTTP ${response.status})`);
+        }
+        continue;
+      }
+
+      const data = await response.json();
+      if (!response.ok) {
+        throw new Error(data.error || 'Failed to get batch status');
+      }
+      consecutiveErrors = 0;
+      if (finished) {
+        return data;
+      }
+      finished = Boolean(data.finished);
+    }
+  }
+
   // Legacy single-image grading
   async gradeSingleAnswer(
     studentImage: string,
@@ -14,6 +14,7 @@ import type {
 } from '@/types/grading';
 import { useConfigManagerStore } from './configManager';
 import { useApiConfigStore } from './apiConfigStore';
+import { apiService } from '@/services/apiService';
 
 export const useGradingStore = defineStore('grading', () => {
   // 统一的状态管理 - 合并所有grading相关功能
@@ -155,7 +156,7 @@ export const useGradingStore = defineStore('grading', () => {
     suggestedRubric.value = '';
 
     try {
-      const response = await fetch('/api/analyze_answer', {
+      const response = await fetch('/api/analyze_answer?slim=1', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -336,7 +337,8 @@ export const useGradingStore = defineStore('grading', () => {
     }
 
     batchProcessingStatus.value = 'processing';
-    currentBatchId.value = `batch_${Date.now()}`;
+    const batchId = `batch_${Date.now()}_${Math.random().toString(36).slice(2, 10)}`;
+    currentBatchId.value = batchId;
     batchProgress.value = {
       total: submissions.length,
       completed: 0,
@@ -364,24 +366,42 @@ export const useGradingStore = defineStore('grading', () => {
           name: sub.name,
           imageData: sub.dataUrl,
         })),
+        // Sent so the job can be polled even if this request's response is lost
+        batchId,
+      };
+      const headers = {
+        'Content-Type': 'application/json',
+        'X-API-URL': apiConfigStore.apiConfig.apiUrl,
+        'X-API-KEY': apiConfigStore.apiConfig.apiKey,
+        'X-MODEL-NAME': apiConfigStore.apiConfig.modelName,
       };
 
-      const response = await fetch('/api/batch_grade', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-          'X-API-URL': apiConfigStore.apiConfig.apiUrl,
-          'X-API-KEY': apiConfigStore.apiConfig.apiKey,
-          'X-MODEL-NAME': apiConfigStore.apiConfig.modelName,
-        },
-        body: JSON.stringify(requestData),
-      });
+      let response: Response | null = null;
+      try {
+        response = await fetch('/api/batch_grade', {
+          method: 'POST',
+          headers,
+          body: JSON.stringify(requestData),
+        });
+      } catch {
+        // The job may have been stored before the connection dropped; poll for it below
+      }
 
-      if (!response.ok) {
+      let data: BatchGradeResponse | null = null;
+      if (response && response.ok) {
+        data = await response.json();
+      } else if (
+        response &&
+        response.status < 500 &&
+        response.status !== 409
+      ) {
         throw new Error(`HTTP ${response.status}: ${response.statusText}`);
       }
-
-      const data: BatchGradeResponse = await response.json();
+      // The backend answers 202 once the job is stored; after a lost response,
+      // a 5xx or a 409 (still being created) the job may exist too. Poll it.
+      if (!data || !data.finished) {
+        data = await apiService.waitForBatch(batchId, headers);
+      }
 
       // 更新提交结果
       data.results.forEach((result) => {
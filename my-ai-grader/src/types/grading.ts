@@ -60,13 +60,14 @@ export interface BatchGradeRequest {
     name: string;
     imageData: string;
   }[];
+  batchId?: string;
 }
 
 export interface BatchGradeResponse {
   batchId: string;
   results: {
     studentId: string;
-    status: 'completed' | 'error';
+    status: 'completed' | 'error' | 'processing' | 'pending';
     feedbackMarkdown?: string;
     error?: string;
   }[];
@@ -76,6 +77,7 @@ export interface BatchGradeResponse {
     errors: number;
     averageScore?: number;
   };
+  finished?: boolean;
 }
 
 // Batch processing state